@@ -10,19 +10,7 @@ import matplotlib.pyplot as plt
 import mpld3
 from matplotlib.ticker import PercentFormatter
 
-def shuffle_deck(seed:int) -> str:
-    '''Generates a single shuffled deck of 0s and 1s. 
-
-    Arguments: 
-    seed (int): Seed to ensure reproducibility
-
-    Output:
-    A string of 52 characters where each character is either '0' or '1', representing a shuffled deck.
-    '''
-    rng = np.random.default_rng(seed = seed) 
-    deck = np.ndarray.flatten((np.stack((np.ones(26), np.zeros(26)), axis= 0).astype(int))) # make a deck of 26 ones and zeroes
-    rng.shuffle(deck) # then shuffle the deck
-    return ''.join(map(str, deck)) # convert to string
+CHUNK_SIZE = 100_000 # games played at once in batched mode
 
 def results_for_viz(x):
     """
@@ -66,49 +54,39 @@ def play_n_games(n: int, data: str, initial_seed: int = 0, batched: bool = False
     The file contains information about each game's outcome, including details such as number of cards won, number 
     of tricks won, and ties that occurred during the games for both variations. If the data folder does 
     not exist, it will be created. The results are added to the results that already exist in the results.json file. 
+
+    Each run is saved under its initial seed (games_<initial_seed>.npy, or batch_<initial_seed>.npy when batched).
+    An unbatched run raises FileExistsError if its file already exists. Runs whose seed ranges overlap are not
+    deduplicated, so the decks they share are counted once per run. Batched and unbatched runs need separate data
+    folders, because a batch total does not record how many games it holds.
     """
     # makes data folder if it does not exist
     if not os.path.exists(data):
-        os.makedirs(os.path.join(data,'cards'))
-        os.makedirs(os.path.join(data,'cards_ties'))
-        os.makedirs(os.path.join(data,'tricks'))
-        os.makedirs(os.path.join(data,'tricks_ties'))
+        os.makedirs(data)
+    processing.check_data_folder(data, batched) # fail before playing rather than after saving
 
+    variations = ['cards', 'tricks', 'cards_ties', 'tricks_ties'] # order of the variations in the packed results
     if batched: 
-        batch_cards = np.zeros((8,8))
-        batch_tricks = np.zeros((8,8))
-        batch_cards_ties = np.zeros((8,8))
-        batch_tricks_ties = np.zeros((8,8))
-
-        for i in range(n): # runs n games
-            deck = shuffle_deck(seed=initial_seed + i)
-            i_cards, i_tricks, i_cards_ties, i_tricks_ties = processing.play_one_deck(data = data, deck = deck, batched = batched)
-
-            batch_cards += i_cards
-            batch_tricks += i_tricks
-            batch_cards_ties += i_cards_ties
-            batch_tricks_ties += i_tricks_ties
-
-        processing.batch_save(batch_cards = batch_cards,
-                              batch_tricks = batch_tricks,
-                              batch_cards_ties = batch_cards_ties,
-                              batch_tricks_ties = batch_tricks_ties,
-                              name = initial_seed,
-                              data = data)
+        # games are played in fixed-size chunks and summed as they go, so memory does not grow with n
+        batch = np.zeros((4, 8, 8), dtype=np.int64)
+        games = np.zeros((min(n, CHUNK_SIZE), 4, 8, 8), dtype=np.int8)
+        for start in range(0, n, CHUNK_SIZE):
+            seeds = np.arange(initial_seed + start, initial_seed + min(start + CHUNK_SIZE, n), dtype=np.int64) # one seed per deck
+            chunk = games[:len(seeds)]
+            processing.simulate(seeds, chunk) # runs the chunk's games in parallel
+            batch += chunk.sum(axis=0, dtype=np.int64)
+
+        processing.batch_save(batch = batch, name = initial_seed, data = data)
     else:
-        for i in range(n):
-            deck = shuffle_deck(seed = initial_seed + i)
-            processing.play_one_deck(data = data, deck = deck, batched = batched)
-
-    filename = ['cards', 'cards_ties', 'tricks', 'tricks_ties']
-    results = {}
-    n_games = []
-
-    # calculate the average for each folder
-    for folder in filename:
-        results[folder], g_num = processing.sum_games(f'{data}/{folder}', True, batched = batched, batched_num_games = batched_num_games,)
-        n_games.append(g_num)
-    results['n'] = n_games[0]
+        games = processing.open_games(data = data, name = initial_seed, num_games = n)
+        seeds = np.arange(initial_seed, initial_seed + n, dtype=np.int64) # one seed per deck, decks are shuffled inside the kernel
+        processing.simulate(seeds, games) # runs n games in parallel, straight into the file
+        games.flush()
+
+    # calculate the average, all four variations are packed in the same files so they are averaged together
+    games_total, num_games = processing.sum_games(data, True, batched = batched, batched_num_games = batched_num_games)
+    results = dict(zip(variations, games_total))
+    results['n'] = num_games
     # Reformatting and save results for viz
     results_for_viz(results)
     return results
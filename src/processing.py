@@ -1,20 +1,82 @@
 import numpy as np
-import pandas as pd
+import numba
 import os
-import itertools
 from typing import Tuple
 
-def score_deck(deck: str,
-               seq1: str,
-               seq2: str) -> Tuple[int, int, int, int]:
+DECK_SIZE = 52
+NUM_STARTS = DECK_SIZE - 2 # number of positions a 3-card sequence can start at
+
+
+@numba.njit(cache=True)
+def _index_deck_bits_nb(deck_bits: np.uint64) -> Tuple[np.ndarray, np.ndarray]:
     '''
-    Given a shuffled deck of cards, a sequence chosen by player two (me), and a sequence chosen by player two (opponent), 
-    return the number of cards/tricks for each variation of Penney's Game.
-    
+    Scan the deck once and record every position each of the 8 possible 3-card sequences starts at. The deck is packed
+    into the low 52 bits of an integer with the first card as the highest bit, so the 3-card sequence starting at
+    position i is just bits 49 - i to 51 - i.
+
+    Arguments:
+        - deck_bits (np.uint64): the packed deck (see _shuffled_bits)
+
+    Outputs:
+        - positions (np.ndarray): (8, 50) array, row s holds the starting positions of sequence s in increasing order
+        - counts (np.ndarray): number of valid entries in each row of positions
+    '''
+    positions = np.empty((8, NUM_STARTS), dtype=np.int64)
+    counts = np.zeros(8, dtype=np.int64)
+    for i in range(NUM_STARTS):
+        tri = np.int64((deck_bits >> np.uint64(NUM_STARTS - 1 - i)) & np.uint64(7))
+        positions[tri, counts[tri]] = i
+        counts[tri] += 1
+    return positions, counts
+
+
+@numba.njit(cache=True)
+def _shuffled_bits(seed: int) -> np.uint64:
+    '''
+    Shuffles a deck of 26 ones and 26 zeroes with a Fisher-Yates shuffle driven by a splitmix64 stream started from seed.
+    The deck is kept packed in an integer the whole time, with the first card as the highest of the 52 bits.
+    The same seed always gives the same deck.
+
+    Arguments:
+        - seed (int): seed to ensure reproducibility
+
+    Output:
+        - deck_bits (np.uint64): the shuffled deck, one bit per card
+    '''
+    # 26 ones followed by 26 zeroes, card i is bit 51 - i
+    deck_bits = ((np.uint64(1) << np.uint64(DECK_SIZE // 2)) - np.uint64(1)) << np.uint64(DECK_SIZE // 2)
+
+    state = np.uint64(seed)
+    for i in range(DECK_SIZE - 1, 0, -1):
+        # splitmix64: step the state and scramble it into the next random number
+        state += np.uint64(0x9E3779B97F4A7C15)
+        z = state
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        z = z ^ (z >> np.uint64(31))
+        j = np.int64(z % np.uint64(i + 1))
+        # swap cards i and j: flipping both bits swaps them when they differ and does nothing when they are equal
+        bit_i = np.uint64(DECK_SIZE - 1 - i)
+        bit_j = np.uint64(DECK_SIZE - 1 - j)
+        differ = ((deck_bits >> bit_i) ^ (deck_bits >> bit_j)) & np.uint64(1)
+        deck_bits ^= (differ << bit_i) | (differ << bit_j)
+
+    return deck_bits
+
+
+@numba.njit(cache=True)
+def _score_pair_nb(positions: np.ndarray,
+                   counts: np.ndarray,
+                   s1: int,
+                   s2: int) -> Tuple[int, int, int, int]:
+    '''
+    Score one pair of sequences from the positions found by _index_deck_bits_nb. Walks both (sorted) position lists together,
+    giving the trick to whichever sequence comes up first and skipping any match that overlaps the cards just won.
+
     Arguments:
-        - deck (str): randomly shuffled deck of 52 cards
-        - seq1 (str): the 3-card sequence chosen by player 1 (opponent) (ex. BBB, RBR)
-        - seq2 (str): the 3-card sequence chosen by player 2 (me) (ex. RRR, BRB)
+        - positions, counts (np.ndarray): output of _index_deck_bits_nb
+        - s1 (int): the sequence chosen by player 1 (opponent) as an integer from 0 to 7
+        - s2 (int): the sequence chosen by player 2 (me) as an integer from 0 to 7
 
     Outputs:
         - p1_cards (int): the number of cards player 1 (opponent) won
@@ -24,33 +86,38 @@ def score_deck(deck: str,
     '''
     p1_cards = 0
     p2_cards = 0
-    pile = 2 # because we are starting at the third position
-    
     p1_tricks = 0
     p2_tricks = 0
-    
-    i = 0
-    while i < len(deck) - 2: # iterate through the deck, adding 1 to the pile for each step, then check the current sequence
-        pile += 1
-        current_sequence = deck[i:i+3]
-      # if the sequence matches either player's sequence, add the current pile to their cards and restart the pile. 
-      # add one to their tricks and move forward three cards in the deck.
-        if current_sequence == seq1:
-            p1_cards += pile
-            pile = 2
+
+    n1 = counts[s1]
+    n2 = counts[s2]
+    i1 = 0
+    i2 = 0
+    start = 0 # position of the first card in the current pile
+    while True:
+        # matches that started inside the last trick do not count
+        while i1 < n1 and positions[s1, i1] < start:
+            i1 += 1
+        while i2 < n2 and positions[s2, i2] < start:
+            i2 += 1
+        pos1 = positions[s1, i1] if i1 < n1 else DECK_SIZE
+        pos2 = positions[s2, i2] if i2 < n2 else DECK_SIZE
+        if pos1 == DECK_SIZE and pos2 == DECK_SIZE:
+            break
+        # player 1 takes the trick on a tie (only possible when s1 == s2)
+        if pos1 <= pos2:
+            p1_cards += pos1 + 3 - start
             p1_tricks += 1
-            i += 3
-        elif current_sequence == seq2:
-            p2_cards += pile
-            pile = 2 
+            start = pos1 + 3
+        else:
+            p2_cards += pos2 + 3 - start
             p2_tricks += 1
-            i += 3
-        else: # if no one wins just move through the deck
-            i += 1
+            start = pos2 + 3
 
     return p1_cards, p2_cards, p1_tricks, p2_tricks
 
 
+@numba.njit(cache=True, inline='always')
 def calculate_winner(p1_cards: int,
                      p2_cards: int,
                      p1_tricks: int,
@@ -72,122 +139,172 @@ def calculate_winner(p1_cards: int,
             - tricks_winner (int): specifies who won based on tricks
             - tricks_draw (int): 1 if a draw occured, 0 otherwise
         '''
-        # initializations only change if p2 wins or there is a draw
-        cards_winner = 0
-        cards_draw = 0
-        tricks_winner = 0
-        tricks_draw = 0
-
-        # if p2 wins, set winner to 1, otherwise it is 0 (including draws)
-        # if there is a draw, set draw counter to 1
-        if p1_cards < p2_cards:
-            cards_winner = 1
-        elif p1_cards == p2_cards:
-            cards_draw = 1
-        if p1_tricks < p2_tricks:
-            tricks_winner = 1
-        elif p1_tricks == p2_tricks: 
-            tricks_draw = 1
+        # p2 wins only on a strict majority, a draw counts as a win for neither player
+        # comparisons instead of if/elif so the compiled kernel has no branches here
+        cards_winner = int(p1_cards < p2_cards)
+        cards_draw = int(p1_cards == p2_cards)
+        tricks_winner = int(p1_tricks < p2_tricks)
+        tricks_draw = int(p1_tricks == p2_tricks)
         return cards_winner, cards_draw, tricks_winner, tricks_draw
 
 
-def play_one_deck(deck: str,
-                  data: str,
-                  batched: bool = False):
+@numba.njit(cache=True)
+def _score_all_pairs_nb(positions: np.ndarray, counts: np.ndarray, out: np.ndarray):
     '''
-    For a single deck, this function plays every possible combination of sequences for both players and saves the outcome as .npy arrays.
-    
+    Scores every combination of sequences from the positions found by _index_deck_bits_nb.
+    Only the 36 pairs with seq1 <= seq2 are scored; the mirrored pair reuses the same scores.
+
     Arguments:
-        - deck (str): a string of either 0 or 1 representing a generated deck.
-        - data (str): the data file information is being saved to.
-        - batched (bool): whether to save each file individually or not, in the case of batch saving for efficiency
+        - positions, counts (np.ndarray): output of _index_deck_bits_nb
+        - out (np.ndarray): (4, 8, 8) int8 array to fill with card wins, trick wins, card draws and trick draws for p2,
+            indexed by [variation, 7 - seq1, seq2] so '000' is in the bottom-left corner
+    '''
+    for k in range(64): # every combination of p1 and p2's choices, as the 6-bit number s1s2
+        s1 = k >> 3
+        s2 = k & 7
+        # two different sequences never start at the same position, so swapping the players just swaps the scores.
+        # each pair is scored once and fills both of its cells
+        if s2 < s1:
+            continue
+        p1_cards, p2_cards, p1_tricks, p2_tricks = _score_pair_nb(positions, counts, s1, s2)
 
-    Output:
-        - p2_wins_cards, p2_wins_tricks (np.ndarray): arrays of card and trick wins for p2
-        - draws_cards, draws_tricks (np.ndarray): arrays of card and trick ties
-    '''
-    sequences = ['000', '001', '010', '011', '100', '101', '110', '111'] # possible selections for either player
-    combinations = itertools.product(sequences, repeat=2) # create all possible combinations of p1 and p2's choices
-    p2_wins_cards = pd.DataFrame(columns=sequences, index=sequences)
-    p2_wins_tricks = pd.DataFrame(columns=sequences, index=sequences)
-    draws_cards = pd.DataFrame(columns=sequences, index=sequences)
-    draws_tricks = pd.DataFrame(columns=sequences, index=sequences)
-
-    for seq1, seq2 in combinations: # for each possible play sequence for p1 and p2: score the deck versus the selections, calculate the winner, and then insert the wins 
-        p1_cards, p2_cards, p1_tricks, p2_tricks = score_deck(deck, seq1, seq2)
+        row = 7 - s1 # rows are reversed so '000' is in the bottom-left corner
         cards_winner, cards_draw, tricks_winner, tricks_draw = calculate_winner(p1_cards, p2_cards, p1_tricks, p2_tricks)
-        # insert wins at the location on the DataFrame corresponding to the two sequences
-        p2_wins_cards.at[seq1, seq2] = cards_winner
-        draws_cards.at[seq1, seq2] = cards_draw
-        p2_wins_tricks.at[seq1, seq2] = tricks_winner
-        draws_tricks.at[seq1, seq2] = tricks_draw
+        out[0, row, s2] = cards_winner
+        out[1, row, s2] = tricks_winner
+        out[2, row, s2] = cards_draw
+        out[3, row, s2] = tricks_draw
+        if s1 == s2: # player 1 wins every tie, so the diagonal has no mirror
+            continue
+
+        row = 7 - s2
+        cards_winner, cards_draw, tricks_winner, tricks_draw = calculate_winner(p2_cards, p1_cards, p2_tricks, p1_tricks)
+        out[0, row, s1] = cards_winner
+        out[1, row, s1] = tricks_winner
+        out[2, row, s1] = cards_draw
+        out[3, row, s1] = tricks_draw
+
+
+@numba.njit(parallel=True, cache=True)
+def simulate(seeds: np.ndarray, out: np.ndarray):
+    '''
+    Shuffles and plays one deck per seed, spreading the decks across all cores. Each deck is shuffled as a 52-bit
+    integer, indexed into a small (8, 50) position table and scored, with results written into out.
+
+    Arguments:
+        - seeds (np.ndarray): int64 array with one seed per deck (see _shuffled_bits)
+        - out (np.ndarray): (num_decks, 4, 8, 8) int8 array filled the same way as in _score_all_pairs_nb
+    '''
+    for d in numba.prange(seeds.shape[0]):
+        positions, counts = _index_deck_bits_nb(_shuffled_bits(seeds[d]))
+        _score_all_pairs_nb(positions, counts, out[d])
+
+
+def open_games(data: str,
+               name: str,
+               num_games: int) -> np.ndarray:
+    '''
+    Creates a memory-mapped .npy file to hold the results of every game in a run, so each game is written in place
+    instead of to its own set of files.
+
+    Arguments:
+        - data (str): the data folder the results are saved to
+        - name (str): name for the run's file (ex. the initial seed)
+        - num_games (int): number of games in the run
+
+    Output:
+        - games (np.memmap): (num_games, 4, 8, 8) int8 array backed by data/games_<name>.npy, with the variations
+            packed along axis 1 in the same order as play_one_deck
+
+    Raises:
+        - FileExistsError: if a run with the same name was already saved, rather than overwriting its games
+    '''
+    file_path = f'{data}/games_{name}.npy'
+    if os.path.exists(file_path):
+        raise FileExistsError(f"{file_path} already exists. Use a different initial seed or remove the old run.")
+    return np.lib.format.open_memmap(file_path, mode='w+', dtype=np.int8, shape=(num_games, 4, 8, 8))
+
+
+def play_one_deck(deck_bits: int) -> np.ndarray:
+    '''
+    For a single deck, this function plays every possible combination of sequences for both players.
     
-    deck_name = str(int(deck, 2)) # convert the binary deck to a number to name the results files
+    Arguments:
+        - deck_bits (int): the deck packed into 52 bits with the first card as the highest bit (ex. _shuffled_bits(seed))
 
-    # Reorder rows to start with '000' in the bottom-left corner
-    reversed_sequences = sequences[::-1]
-    p2_wins_cards = p2_wins_cards.loc[reversed_sequences, :]
-    p2_wins_tricks = p2_wins_tricks.loc[reversed_sequences, :]
-    draws_cards = draws_cards.loc[reversed_sequences, :]
-    draws_tricks = draws_tricks.loc[reversed_sequences, :]
+    Output:
+        - results (np.ndarray): (4, 8, 8) int8 array of card wins, trick wins, card ties and trick ties for p2
+    '''
+    results = np.zeros((4, 8, 8), dtype=np.int8)
+    positions, counts = _index_deck_bits_nb(np.uint64(deck_bits))
+    _score_all_pairs_nb(positions, counts, results) # play every combination of p1 and p2's choices
+    return results
 
-    if batched:
-        return p2_wins_cards, p2_wins_tricks, draws_cards, draws_tricks
-
-    else:
-        # save the results to different folders for each variation
-        np.save(f'{data}/cards/{deck_name}.npy', p2_wins_cards, allow_pickle = True)
-        np.save(f'{data}/tricks/{deck_name}.npy', p2_wins_tricks, allow_pickle = True)
-        np.save(f'{data}/cards_ties/{deck_name}.npy', draws_cards, allow_pickle = True)
-        np.save(f'{data}/tricks_ties/{deck_name}.npy', draws_tricks, allow_pickle = True)
-    return p2_wins_cards, p2_wins_tricks, draws_cards, draws_tricks
-
-def batch_save(batch_cards: np.ndarray,
-               batch_tricks: np.ndarray,
-               batch_cards_ties: np.ndarray,
-               batch_tricks_ties: np.ndarray,
+def batch_save(batch: np.ndarray,
                name: str,
                data: str = 'data/'):
     '''
-    Saves cards and tricks for batched data.
+    Saves cards and tricks for batched data. All four variations go in one file with a single header and one contiguous
+    write. The file is a plain integer array (no pickling), so it can be memory-mapped by sum_games.
 
     Arguments:
-        - batch_cards, batch_tricks, batch_cards_ties, batch_tricks_ties (np.ndarray): card wins, trick wins, card ties, and trick ties for the batch
+        - batch (np.ndarray): (4, 8, 8) array of card wins, trick wins, card ties, and trick ties for the batch
+        - name (str): name for the batch's file (ex. the initial seed)
+        - data (str): the data folder the batch is saved to
     '''
-    np.save(f'{data}/cards/batch_{name}.npy', batch_cards, allow_pickle = True)
-    np.save(f'{data}/tricks/batch_{name}.npy', batch_tricks, allow_pickle = True)
-    np.save(f'{data}/cards_ties/batch_{name}.npy', batch_cards_ties, allow_pickle = True)
-    np.save(f'{data}/tricks_ties/batch_{name}.npy', batch_tricks_ties, allow_pickle = True)
+    np.save(f'{data}/batch_{name}.npy', batch, allow_pickle = False)
     return
 
 
+def check_data_folder(data: str, batched: bool):
+    '''
+    Checks that the data folder holds no results from the other kind of run, before a new run adds to it.
+
+    Arguments:
+        - data (str): the filepath to the specified data folder
+        - batched (bool): whether the new run is batched
+
+    Raises:
+        - ValueError: if a batched run would join per-run games (games_*.npy) or an unbatched run would join batch
+            totals (batch_*.npy), which sum_games cannot count together
+    '''
+    other = 'games_' if batched else 'batch_'
+    if any(entry.is_file() and entry.name.startswith(other) for entry in os.scandir(data)):
+        raise ValueError(f"{data} already holds {'unbatched' if batched else 'batched'} results. Keep each kind of run in its own data folder.")
+
+
 def sum_games(data: str, average: bool, batched_num_games: int, batched: bool = False)-> Tuple[np.ndarray, int]:
     '''
     Iterate over each file in the specified data filepath, and calculates the sum (or the average).
 
     Arguments:
         - data (str): the filepath to the specified data folder
-        - average (bool): if True, returns the average (by dividing by the number of files in the directory)
+        - average (bool): if True, returns the average (by dividing by the number of games in the directory)
     
     Output:
-        - games_total (numpy.ndarray): a numpy array that either contains:
+        - games_total (numpy.ndarray): a (4, 8, 8) numpy array, packed like play_one_deck, that either contains:
             - the average of the files if average is True
             - the sum of the files if average is False
         - num_games (int): the number of games played
+
+    Raises:
+        - ValueError: if the folder holds both batch totals (batch_*.npy) and per-run games (games_*.npy). A batch total
+            does not record how many games it holds, so the two cannot be counted together
     '''
-    files = [file for file in os.listdir(data) if os.path.isfile(os.path.join(data, file))] # iterate through /data directory, only process files
-    games_total = None # where the sum of the games is going
+    entries = [entry for entry in os.scandir(data) if entry.is_file()] # iterate through /data directory, only process files
+    names = [entry.name for entry in entries]
+    if any(name.startswith('batch_') for name in names) and any(name.startswith('games_') for name in names):
+        raise ValueError(f"{data} holds both batched and unbatched results. Keep each kind of run in its own data folder.")
+    files = [entry.path for entry in entries]
+    games_total = np.zeros((4, 8, 8), dtype=np.int64) # where the sum of the games is going, int64 so int8 results cannot overflow
+    num_games = 0
     for file in files:
-        file_path = os.path.join(data,file) # get file name and directory
-        game = np.load(file_path, allow_pickle=True) # load the file
-        if games_total is None:
-            games_total = game # initialize games_total sum array
-        else:
-            games_total += game
+        # map the file rather than reading it into a new array. files hold either a single batch total or a stack of games
+        games = np.load(file, mmap_mode='r').reshape(-1, 4, 8, 8)
+        np.add(games_total, games.sum(axis=0, dtype=np.int64), out=games_total)
+        num_games += games.shape[0]
     if batched:
         num_games = batched_num_games
-    else:
-        num_games = len(files)
     if average:
         return np.divide(games_total, num_games), num_games
     return games_total, num_games # divide each individual element by the number of games played